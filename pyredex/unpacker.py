@@ -5,20 +5,51 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
+import contextlib
+import errno
 import hashlib
+import io
+import itertools
 import json
+import lzma
 import os
 import re
 import subprocess
 import shutil
 import string
+import struct
+import time
 import zipfile
+import zlib
 
-from os.path import basename, dirname, getsize, isdir, isfile, join
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, getsize, isfile, join
 
 from pyredex.utils import abs_glob, make_temp_dir
 from pyredex.log import log
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Matches the jar size recorded in an XZS .meta file, e.g. 'jar:1234 dex:5678'
+_JAR_SIZE_RE = re.compile(br'jar:(\d+)')
+
+DEX_JAR_MANIFEST_NAME = '/META-INF/MANIFEST.MF'
+DEX_JAR_MANIFEST = (b'Manifest-Version: 1.0\n'
+                    b'Dex-Location: classes.dex\n'
+                    b'Created-By: redex\n\n')
+
+# Precomputed pieces of the stored jars built by write_stored_dex_jar
+_DEX_JAR_DEX_NAME = b'classes.dex'
+_DEX_JAR_MANIFEST_NAME = DEX_JAR_MANIFEST_NAME.encode('ascii')
+_DEX_JAR_MANIFEST_CRC = zlib.crc32(DEX_JAR_MANIFEST)
+_ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_ZIP_LOCAL_HEADER_CRC_OFFSET = 14
+_ZIP_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_ZIP_END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+
 class ApplicationModule(object):
 
     def __init__(self, extracted_apk_dir, name, canary_prefix, dependencies):
@@ -67,13 +98,14 @@ class ApplicationModule(object):
             json.dump(metadata, store_metadata)
 
     def unpackage(self, extracted_apk_dir, dex_dir):
+        layout = ApkLayout(extracted_apk_dir)
         self.dex_mode = XZSDexMode(dex_asset_dir=self.path,
                                    store_name=self.name,
                                    dex_prefix=self.name,
                                    canary_prefix=self.canary_prefix,
                                    store_id=self.name,
                                    dependencies=self.dependencies)
-        if (self.dex_mode.detect(extracted_apk_dir)):
+        if (self.dex_mode.detect(extracted_apk_dir, layout)):
             log('module ' + self.name + ' is XZSDexMode')
             self.dex_mode.unpackage(extracted_apk_dir, dex_dir)
         else:
@@ -83,7 +115,7 @@ class ApplicationModule(object):
                                           canary_prefix=self.canary_prefix,
                                           store_id=self.name,
                                           dependencies=self.dependencies)
-            if (self.dex_mode.detect(extracted_apk_dir)):
+            if (self.dex_mode.detect(extracted_apk_dir, layout)):
                 log('module ' + self.name + ' is SubdirDexMode')
                 self.dex_mode.unpackage(extracted_apk_dir, dex_dir)
             else:
@@ -103,36 +135,89 @@ class DexMetadata(object):
                  store=None,
                  dependencies=None,
                  have_locators=False,
-                 is_root_relative=False):
+                 is_root_relative=False,
+                 hasher=None):
         self._have_locators = False
         self._store = store
         self._dependencies = dependencies
         self._have_locators = have_locators
         self._is_root_relative = is_root_relative
+        self._hasher = hasher if hasher is not None else dex_hasher()
         self._dexen = []
 
+    def hash_file(self, path):
+        """
+        Returns the hex digest of the file at path, as recorded in the
+        metadata, together with the file's size.
+        """
+        return hash_file(path, self._hasher)
+
     def add_dex(self, dex_path, canary_class, hash=None):
         if hash is None:
-            with open(dex_path, 'rb') as dex:
-                sha1hash = hashlib.sha1(dex.read()).hexdigest()
-        else:
-            sha1hash = hash
+            hash, _ = self.hash_file(dex_path)
         self._dexen.append(
-            (os.path.basename(dex_path), sha1hash, canary_class))
+            (os.path.basename(dex_path), hash, canary_class))
 
     def write(self, path):
+        # Build the whole file up front so it goes out in a single write
+        lines = []
+        if self._store is not None:
+            lines.append('.id ' + self._store)
+        if self._dependencies is not None:
+            for dependency in self._dependencies:
+                lines.append('.requires ' + dependency)
+        if self._is_root_relative:
+            lines.append('.root_relative')
+        if self._have_locators:
+            lines.append('.locators')
+        for dex in self._dexen:
+            lines.append(' '.join(dex))
         with open(path, 'w') as meta:
-            if self._store is not None:
-                meta.write('.id ' + self._store + '\n')
-            if self._dependencies is not None:
-                for dependency in self._dependencies:
-                    meta.write('.requires ' + dependency + '\n')
-            if self._is_root_relative:
-                meta.write('.root_relative\n')
-            if self._have_locators:
-                meta.write('.locators\n')
-            for dex in self._dexen:
-                meta.write(' '.join(dex) + '\n')
+            meta.write(''.join(line + '\n' for line in lines))
+
+
+class ApkLayout(object):
+    """
+    Caches the directory listings of an extracted apk, so that probing it for
+    each dex mode in turn costs one scandir per directory instead of a stat
+    per candidate path.
+    """
+
+    def __init__(self, extracted_apk_dir):
+        self._extracted_apk_dir = extracted_apk_dir
+        self._listings = {}
+
+    def list_dir(self, relpath=''):
+        """
+        Returns a dict of entry name -> whether it is a file, for the
+        directory at relpath in the apk, or None if there is no such
+        directory.
+        """
+        if relpath not in self._listings:
+            try:
+                with os.scandir(join(self._extracted_apk_dir,
+                                     relpath)) as entries:
+                    listing = {entry.name: entry.is_file()
+                               for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                listing = None
+            self._listings[relpath] = listing
+        return self._listings[relpath]
+
+    def is_file(self, relpath):
+        directory, name = os.path.split(relpath)
+        listing = self.list_dir(directory)
+        return listing is not None and listing.get(name, False)
+
+    def has_file_with_suffix(self, relpath, suffix):
+        """
+        Returns whether the directory at relpath has a non-hidden entry whose
+        name ends with suffix.
+        """
+        listing = self.list_dir(relpath)
+        return listing is not None and \
+                any(name.endswith(suffix) and not name.startswith('.')
+                    for name in listing)
 
 
 class BaseDexMode(object):
@@ -141,19 +226,41 @@ class BaseDexMode(object):
         self._canary_prefix = canary_prefix
         self._store_id = store_id
         self._dependencies = dependencies
+        self._canaries = {}
 
     def unpackage(self, extracted_apk_dir, dex_dir):
         primary_dex = join(extracted_apk_dir, self._dex_prefix + '.dex')
         if os.path.exists(primary_dex):
-            shutil.move(primary_dex, dex_dir)
+            fast_move(primary_dex, join(dex_dir, basename(primary_dex)))
 
     def repackage(self, extracted_apk_dir, dex_dir, have_locators):
         primary_dex = join(dex_dir, self._dex_prefix + '.dex')
         if os.path.exists(primary_dex):
-            shutil.move(primary_dex, extracted_apk_dir)
+            fast_move(primary_dex,
+                      join(extracted_apk_dir, basename(primary_dex)))
 
     def get_canary(self, i):
-        return self._canary_prefix + '.dex%02d.Canary' % i
+        canary = self._canaries.get(i)
+        if canary is None:
+            canary = self._canary_prefix + '.dex%02d.Canary' % i
+            self._canaries[i] = canary
+        return canary
+
+    def get_secondary_dex_numbers(self, dex_dir):
+        """
+        Returns N for each of the consecutive <dex_prefix>N.dex files in
+        dex_dir, starting from N = 2.
+        """
+        # List the directory once rather than probing each candidate path
+        with os.scandir(dex_dir) as entries:
+            dex_names = set(entry.name for entry in entries
+                            if entry.name.endswith('.dex'))
+        numbers = []
+        for i in itertools.count(2):
+            if self._dex_prefix + '%d.dex' % i not in dex_names:
+                break
+            numbers.append(i)
+        return numbers
 
 class Api21DexMode(BaseDexMode):
     """
@@ -174,11 +281,13 @@ class Api21DexMode(BaseDexMode):
         self._secondary_dir = dex_asset_dir
         self._is_root_relative = is_root_relative
 
-    def detect(self, extracted_apk_dir):
+    def detect(self, extracted_apk_dir, layout=None):
         # Note: This mode is the fallback and we only check for it after
         # checking for the other modes. This should return true for any
         # apk.
-        return isfile(join(extracted_apk_dir, self._dex_prefix + '.dex'))
+        if layout is None:
+            layout = ApkLayout(extracted_apk_dir)
+        return layout.is_file(self._dex_prefix + '.dex')
 
     def unpackage(self, extracted_apk_dir, dex_dir):
         BaseDexMode.unpackage(self, extracted_apk_dir, dex_dir)
@@ -191,8 +300,15 @@ class Api21DexMode(BaseDexMode):
             extracted_dex_dir = extracted_apk_dir
         else:
             extracted_dex_dir = metadata_dir
-        for path in abs_glob(extracted_dex_dir, '*.dex'):
-            shutil.move(path, dex_dir)
+        # Collect the dexen first; moving them while scanning the directory
+        # would modify it mid-iteration.
+        with os.scandir(extracted_dex_dir) as entries:
+            dexen = [entry.name for entry in entries
+                     if entry.name.endswith('.dex') and
+                     not entry.name.startswith('.') and
+                     entry.is_file(follow_symlinks=False)]
+        for name in dexen:
+            fast_move(join(extracted_dex_dir, name), join(dex_dir, name))
 
     def repackage(self, extracted_apk_dir, dex_dir, have_locators):
         BaseDexMode.repackage(self, extracted_apk_dir, dex_dir, have_locators)
@@ -202,15 +318,14 @@ class Api21DexMode(BaseDexMode):
                                have_locators=have_locators,
                                store=self._store_id,
                                dependencies=self._dependencies)
-        for i in range(2, 100):
-            dex_path = join(dex_dir, self._dex_prefix + '%d.dex' % i)
-            if not isfile(dex_path):
-                break
+        for i in self.get_secondary_dex_numbers(dex_dir):
+            dex_name = self._dex_prefix + '%d.dex' % i
+            dex_path = join(dex_dir, dex_name)
             metadata.add_dex(dex_path, BaseDexMode.get_canary(self, i - 1))
             if self._is_root_relative:
-                shutil.move(dex_path, extracted_apk_dir)
+                fast_move(dex_path, join(extracted_apk_dir, dex_name))
             else:
-                shutil.move(dex_path, metadata_dir)
+                fast_move(dex_path, join(metadata_dir, dex_name))
         if os.path.exists(metadata_dir):
             metadata.write(join(metadata_dir, 'metadata.txt'))
 
@@ -236,9 +351,10 @@ class Api21ModuleDexMode(Api21DexMode):
         self._secondary_dir = dex_asset_dir
         self._store_name = store_name
 
-    def detect(self, extracted_apk_dir):
-        secondary_dex_dir = join(extracted_apk_dir, self._secondary_dir)
-        return len(list(abs_glob(secondary_dex_dir, '*.dex')))
+    def detect(self, extracted_apk_dir, layout=None):
+        if layout is None:
+            layout = ApkLayout(extracted_apk_dir)
+        return layout.has_file_with_suffix(self._secondary_dir, '.dex')
 
 class SubdirDexMode(BaseDexMode):
     """
@@ -256,10 +372,10 @@ class SubdirDexMode(BaseDexMode):
         self._secondary_dir = dex_asset_dir
         self._store_name = store_name
 
-    def detect(self, extracted_apk_dir):
-        secondary_dex_dir = join(extracted_apk_dir, self._secondary_dir)
-        return isdir(secondary_dex_dir) and \
-                len(list(abs_glob(secondary_dex_dir, '*.dex.jar')))
+    def detect(self, extracted_apk_dir, layout=None):
+        if layout is None:
+            layout = ApkLayout(extracted_apk_dir)
+        return layout.has_file_with_suffix(self._secondary_dir, '.dex.jar')
 
     def unpackage(self, extracted_apk_dir, dex_dir):
         jars = abs_glob(join(extracted_apk_dir, self._secondary_dir),
@@ -278,30 +394,39 @@ class SubdirDexMode(BaseDexMode):
         metadata = DexMetadata(have_locators=have_locators,
                                store=self._store_id,
                                dependencies=self._dependencies)
-        for i in range(1, 100):
+        secondary_dir = join(extracted_apk_dir, self._secondary_dir)
+
+        def build_jar(i):
             oldpath = join(dex_dir, self._dex_prefix + '%d.dex' % (i + 1))
             dexpath = join(dex_dir, self._store_name + '-%d.dex' % i)
-            if not isfile(oldpath):
-                break
-            shutil.move(oldpath, dexpath)
+            fast_move(oldpath, dexpath)
 
             jarpath = dexpath + '.jar'
-            create_dex_jar(jarpath, dexpath)
-            metadata.add_dex(jarpath, BaseDexMode.get_canary(self, i))
-
-            dex_meta_base = jarpath + '.meta'
-            dex_meta_path = join(dex_dir, dex_meta_base)
-            with open(dex_meta_path, 'w') as dex_meta:
-                dex_meta.write('jar:%d dex:%d\n' %
-                               (getsize(jarpath), getsize(dexpath)))
-
-            shutil.move(dex_meta_path,
-                        join(extracted_apk_dir, self._secondary_dir))
-            shutil.move(jarpath, join(extracted_apk_dir,
-                                      self._secondary_dir))
+            dex_size = create_dex_jar(jarpath, dexpath)
+            # This reads the jar back once after it's written. The digest
+            # can't be fused into the write: the jar's first bytes are the
+            # local header, whose CRC is only patched in after the dex body
+            # has been written.
+            digest, jar_size = metadata.hash_file(jarpath)
+
+            # Write the .meta file straight into the apk rather than moving it
+            dex_meta_path = join(secondary_dir, basename(jarpath) + '.meta')
+            write_small_file(dex_meta_path,
+                             b'jar:%d dex:%d\n' % (jar_size, dex_size))
+            return jarpath, digest
+
+        # Jars are independent of each other, so build them in parallel and
+        # only serialize the (ordered) metadata bookkeeping.
+        indices = [n - 1 for n in self.get_secondary_dex_numbers(dex_dir)]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, (jarpath, digest) in \
+                    zip(indices, executor.map(build_jar, indices)):
+                metadata.add_dex(jarpath, BaseDexMode.get_canary(self, i),
+                                 hash=digest)
+                fast_move(jarpath, join(secondary_dir, basename(jarpath)))
         jar_meta_path = join(dex_dir, 'metadata.txt')
         metadata.write(jar_meta_path)
-        shutil.move(jar_meta_path, join(extracted_apk_dir, self._secondary_dir))
+        fast_move(jar_meta_path, join(secondary_dir, 'metadata.txt'))
 
 class XZSDexMode(BaseDexMode):
     """
@@ -323,10 +448,10 @@ class XZSDexMode(BaseDexMode):
         self._xzs_filename = store_name + '.dex.jar.xzs'
         self._store_name = store_name
 
-    def detect(self, extracted_apk_dir):
-        path = join(extracted_apk_dir, self._xzs_dir,
-                self._xzs_filename)
-        return isfile(path)
+    def detect(self, extracted_apk_dir, layout=None):
+        if layout is None:
+            layout = ApkLayout(extracted_apk_dir)
+        return layout.is_file(join(self._xzs_dir, self._xzs_filename))
 
     def unpackage(self, extracted_apk_dir, dex_dir):
         src = join(extracted_apk_dir, self._xzs_dir,
@@ -334,12 +459,7 @@ class XZSDexMode(BaseDexMode):
         dest = join(dex_dir, self._xzs_filename)
 
         # Move secondary dexen
-        shutil.move(src, dest)
-
-        # concat_jar is a bunch of .dex.jar files concatenated together.
-        concat_jar = join(dex_dir, self._xzs_filename[:-4])
-        cmd = 'cat {} | xz -d --threads 6 > {}'.format(dest, concat_jar)
-        subprocess.check_call(cmd, shell=True)
+        fast_move(src, dest)
 
         dex_order = []
         with open(join(extracted_apk_dir, self._xzs_dir, 'metadata.txt')) as dex_metadata:
@@ -354,36 +474,44 @@ class XZSDexMode(BaseDexMode):
 
         # Sizes of the concatenated .dex.jar files are stored in .meta files.
         # Read the sizes of each .dex.jar file and un-concatenate them.
-        jar_size_regex = 'jar:(\d+)'
         secondary_dir = join(extracted_apk_dir, self._xzs_dir)
         jar_sizes = {}
         for i in dex_order:
             filename = self._store_name + '-%d.dex.jar.xzs.tmp~.meta' % i
             metadata_path = join(secondary_dir, filename)
             if isfile(metadata_path):
-                with open(metadata_path) as f:
+                with open(metadata_path, 'rb') as f:
                     jar_sizes[i] = \
-                            int(re.match(jar_size_regex, f.read()).group(1))
+                            int(_JAR_SIZE_RE.match(f.read(64)).group(1))
                 os.remove(metadata_path)
                 log('found jar ' + filename + ' of size ' + str(jar_sizes[i]))
             else:
                 break
 
-        with open(concat_jar, 'rb') as cj:
+        # The .xzs file is a bunch of .dex.jar files concatenated together and
+        # then xz-compressed. Decompress it in a single streaming pass,
+        # splitting the output into the individual jars as we go.
+        with lzma.open(dest, 'rb') as concat_jar:
             for i in dex_order:
                 jarpath = join(dex_dir, self._store_name + '-%d.dex.jar' % i)
-                with open(jarpath, 'wb') as jar:
-                    jar.write(cj.read(jar_sizes[i]))
+                remaining = jar_sizes[i]
+                with open(jarpath, 'wb', buffering=1 << 20) as jar:
+                    while remaining:
+                        chunk = concat_jar.read(min(remaining, 256 * 1024))
+                        if not chunk:
+                            break
+                        jar.write(chunk)
+                        remaining -= len(chunk)
+            trailing = concat_jar.read(1)
 
         for j in jar_sizes.keys():
             jar_size = getsize(dex_dir + '/' + self._store_name + '-' + str(j) + '.dex.jar')
             log('validating ' + self._store_name + '-' + str(j) + '.dex.jar size=' + str(jar_size) + ' expecting=' + str(jar_sizes[j]))
             assert jar_sizes[j] == jar_size
 
-        assert sum(jar_sizes.values()) == getsize(concat_jar)
+        assert not trailing, 'Unexpected data after the last jar in ' + dest
 
         # Clean up everything other than dexen in the dex directory
-        os.remove(concat_jar)
         os.remove(dest)
 
         # Lastly, unzip all the jar files and delete them
@@ -395,59 +523,47 @@ class XZSDexMode(BaseDexMode):
     def repackage(self, extracted_apk_dir, dex_dir, have_locators):
         BaseDexMode.repackage(self, extracted_apk_dir, dex_dir, have_locators)
 
-        dex_sizes = {}
-        jar_sizes = {}
-
-        concat_jar_path = join(dex_dir, self._store_name + '.dex.jar')
-        concat_jar_meta = join(dex_dir, 'metadata.txt')
+        secondary_dex_dir = join(extracted_apk_dir, self._xzs_dir)
         dex_metadata = DexMetadata(have_locators=have_locators,
                                    store=self._store_id,
                                    dependencies=self._dependencies)
 
-        with open(concat_jar_path, 'wb') as concat_jar:
-            for i in range(1, 100):
-                oldpath = join(dex_dir, self._dex_prefix + '%d.dex' % (i + 1))
-                if not isfile(oldpath):
-                    break
-                dexpath = join(dex_dir, self._store_name + '-%d.dex' % i)
-
-                # Package each dex into a jar
-                shutil.move(oldpath, dexpath)
-                jarpath = dexpath + '.jar'
-                create_dex_jar(jarpath, dexpath)
-                dex_sizes[jarpath] = getsize(dexpath)
-                jar_sizes[jarpath] = getsize(jarpath)
-
-                # Concatenate the jar files and create corresponding metadata files
-                with open(jarpath + '.xzs.tmp~.meta', 'w') as metadata:
-                    sizes = 'jar:{} dex:{}'.format(
-                        jar_sizes[jarpath], dex_sizes[jarpath])
-                    metadata.write(sizes)
-
-                with open(jarpath, 'rb') as jar:
-                    contents = jar.read()
-                    concat_jar.write(contents)
-                    sha1hash = hashlib.sha1(contents).hexdigest()
+        def build_jar(i):
+            oldpath = join(dex_dir, self._dex_prefix + '%d.dex' % (i + 1))
+            dexpath = join(dex_dir, self._store_name + '-%d.dex' % i)
+
+            # Package each dex into a jar
+            fast_move(oldpath, dexpath)
+            jarpath = dexpath + '.jar'
+            dex_size = create_dex_jar(jarpath, dexpath)
+            digest, jar_size = dex_metadata.hash_file(jarpath)
+
+            # Create the metadata file that records the jar's size within the
+            # concatenation, directly in the apk
+            write_small_file(
+                join(secondary_dex_dir, basename(jarpath) + '.xzs.tmp~.meta'),
+                b'jar:%d dex:%d' % (jar_size, dex_size))
+
+            return jarpath, jar_size, dex_size, digest
+
+        # Stream the jars, in order, straight into the compressor as soon as
+        # each one is built, so compression overlaps with building the
+        # remaining jars and the uncompressed concatenation never touches the
+        # disk. REDEX_XZ_LEVEL trades size for speed (defaults to 6).
+        indices = [n - 1 for n in self.get_secondary_dex_numbers(dex_dir)]
+        xzs_path = join(secondary_dex_dir, self._xzs_filename)
+        with open(xzs_path, 'wb', buffering=1 << 20) as xzs, \
+                xz_compressor(xzs, xz_compression_level()) as concat_jar, \
+                ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, (jarpath, jar_size, dex_size, digest) in \
+                    zip(indices, executor.map(build_jar, indices)):
+                append_file(concat_jar, jarpath, jar_size)
 
                 dex_metadata.add_dex(jarpath + '.xzs.tmp~',
                                      BaseDexMode.get_canary(self, i),
-                                     hash=sha1hash)
+                                     hash=digest)
 
-        dex_metadata.write(concat_jar_meta)
-        assert getsize(concat_jar_path) == sum(getsize(x)
-                for x in abs_glob(dex_dir, self._store_name + '-*.dex.jar'))
-
-        # XZ-compress the result
-        subprocess.check_call(['xz', '-z6', '--check=crc32', '--threads=6',
-                concat_jar_path])
-
-        # Copy all the archive and metadata back to the apk directory
-        secondary_dex_dir = join(extracted_apk_dir, self._xzs_dir)
-        for path in abs_glob(dex_dir, self._store_name + '*.meta'):
-            shutil.copy(path, secondary_dex_dir)
-        shutil.copy(concat_jar_meta, join(secondary_dex_dir, 'metadata.txt'))
-        shutil.copy(concat_jar_path + '.xz',
-                join(secondary_dex_dir, self._xzs_filename))
+        dex_metadata.write(join(secondary_dex_dir, 'metadata.txt'))
 
 
 # These are checked in order from top to bottom. The first one to have detect()
@@ -460,26 +576,266 @@ SECONDARY_DEX_MODES = [
 
 
 def detect_secondary_dex_mode(extracted_apk_dir):
+    layout = ApkLayout(extracted_apk_dir)
     for mode in SECONDARY_DEX_MODES:
-        if mode.detect(extracted_apk_dir):
+        if mode.detect(extracted_apk_dir, layout):
             return mode
     raise Exception('Unknown secondary dex mode')
 
 
+def fast_move(src, dst):
+    """
+    Moves src to the full destination path dst. Within a filesystem this is a
+    single rename(); we only fall back to shutil.move's copy-and-delete when
+    the move crosses filesystems.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def append_file(dst, src_path, size):
+    """
+    Appends the size bytes of src_path to the binary stream dst, e.g. a
+    compressor's stdin pipe or an LzmaWriter. When dst is a pipe and the
+    platform has sendfile, the copy happens in the kernel so the bytes never
+    pass through userspace. Otherwise it's a buffered copy.
+    """
+    with open(src_path, 'rb', buffering=0) as src:
+        try:
+            dst_fd = dst.fileno()
+        except io.UnsupportedOperation:
+            # Not backed by a file descriptor, e.g. an LzmaWriter
+            dst_fd = None
+
+        remaining = size
+        if dst_fd is not None and not dst.seekable() and \
+                hasattr(os, 'sendfile'):
+            dst.flush()
+            try:
+                while remaining:
+                    n = os.sendfile(dst_fd, src.fileno(), None, remaining)
+                    if not n:
+                        break
+                    remaining -= n
+            except OSError as e:
+                # Only fall back if nothing was copied yet, so the source
+                # offset is still where we started
+                if remaining != size or e.errno not in (
+                        errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK):
+                    raise
+        if remaining == size:
+            buf = bytearray(min(size, 256 * 1024))
+            view = memoryview(buf)
+            while remaining:
+                n = src.readinto(view[:min(len(buf), remaining)])
+                if not n:
+                    break
+                dst.write(view[:n])
+                remaining -= n
+    assert remaining == 0, src_path + ' is shorter than expected'
+
+
+def dex_hasher():
+    """
+    Returns the hash constructor used for the digests in dex metadata files.
+    This is SHA-1 unless REDEX_DEX_HASH=blake3 is set; only use that if the
+    app's dex loader accepts BLAKE3 digests. The digests are integrity tags,
+    not a security boundary.
+    """
+    name = os.environ.get('REDEX_DEX_HASH', 'sha1')
+    if name == 'sha1':
+        return hashlib.sha1
+    if name == 'blake3':
+        if blake3 is None:
+            raise Exception('REDEX_DEX_HASH=blake3 requires the blake3 module')
+        return blake3.blake3
+    raise Exception('Unsupported REDEX_DEX_HASH: ' + name)
+
+
+def hash_file(path, hasher=hashlib.sha1):
+    """
+    Returns the hex digest and the size of the file at path, reading it in
+    chunks so we never hold a whole dex or jar in memory.
+    """
+    h = hasher()
+    size = 0
+    with open(path, 'rb', buffering=1 << 20) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+def write_small_file(path, data):
+    """
+    Writes data (bytes) to path with a single unbuffered write. Used for the
+    tiny per-jar .meta files, where the buffered IO stack is pure overhead.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class LzmaWriter(io.RawIOBase):
+    """
+    Write-only stream that xz-compresses everything written to it into
+    fileobj, in-process. Closing it finishes the xz stream but leaves fileobj
+    open.
+    """
+
+    def __init__(self, fileobj, preset):
+        io.RawIOBase.__init__(self)
+        self._fileobj = fileobj
+        self._compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ,
+                                               check=lzma.CHECK_CRC32,
+                                               preset=preset)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._fileobj.write(compressed)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.write(self._compressor.flush())
+        io.RawIOBase.close(self)
+
+
+@contextlib.contextmanager
+def xz_compressor(fileobj, level):
+    """
+    Yields a writable binary stream whose contents end up xz-compressed, with
+    a CRC32 check, in fileobj. Uses the xz binary on every available core
+    when it is installed, and falls back to the (single-threaded) lzma module
+    in-process otherwise.
+    """
+    if shutil.which('xz') is None:
+        with LzmaWriter(fileobj, level) as writer:
+            yield writer
+        return
+
+    cmd = ['xz', '-z', '-%d' % level, '--check=crc32', '--threads=0']
+    fileobj.flush()
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fileobj) as xz:
+        yield xz.stdin
+        xz.stdin.close()
+    if xz.returncode != 0:
+        raise subprocess.CalledProcessError(xz.returncode, cmd)
+
+
+def xz_compression_level():
+    level = os.environ.get('REDEX_XZ_LEVEL', '6')
+    try:
+        level = int(level)
+    except ValueError:
+        raise Exception('REDEX_XZ_LEVEL must be an integer, got ' + level)
+    if not 0 <= level <= 9:
+        raise Exception('REDEX_XZ_LEVEL must be in [0, 9], got %d' % level)
+    return level
+
+
 def extract_dex_from_jar(jarpath, dexpath):
-    dest_directory = dirname(dexpath)
     with zipfile.ZipFile(jarpath) as jar:
-        contents = jar.namelist()
-        dexfiles = [name for name in contents if name.endswith('dex')]
-        assert len(dexfiles) == 1, 'Expected a single dex file'
-        dexname = jar.extract(dexfiles[0], dest_directory)
-        os.rename(join(dest_directory, dexname), dexpath)
+        dexfile = next((info for info in jar.infolist()
+                        if info.filename.endswith('.dex')), None)
+        assert dexfile is not None, 'Expected a single dex file'
+        # Stream the entry straight to dexpath instead of extracting it under
+        # its archive name and renaming it
+        with jar.open(dexfile) as src, open(dexpath, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 256 * 1024)
 
 
 def create_dex_jar(jarpath, dexpath, compression=zipfile.ZIP_STORED):
+    """
+    Packages dexpath as classes.dex in a new jar at jarpath. Returns the size
+    of the dex.
+    """
+    if compression == zipfile.ZIP_STORED:
+        return write_stored_dex_jar(jarpath, dexpath)
     with zipfile.ZipFile(jarpath, mode='w') as zf:
         zf.write(dexpath, 'classes.dex', compress_type=compression)
-        zf.writestr('/META-INF/MANIFEST.MF',
-                b'Manifest-Version: 1.0\n'
-                b'Dex-Location: classes.dex\n'
-                b'Created-By: redex\n\n')
+        zf.writestr(DEX_JAR_MANIFEST_NAME, DEX_JAR_MANIFEST)
+        return zf.getinfo('classes.dex').file_size
+
+
+def write_stored_dex_jar(jarpath, dexpath):
+    """
+    Writes the same uncompressed jar that zipfile would for create_dex_jar,
+    but emits the zip records directly. The dex is copied and CRC'd in a
+    single pass, and its local header is patched with the CRC afterwards.
+    Returns the size of the dex.
+    """
+    buf = bytearray(256 * 1024)
+    view = memoryview(buf)
+    with open(dexpath, 'rb', buffering=0) as dex, \
+            open(jarpath, 'wb', buffering=1 << 20) as jar:
+        st = os.fstat(dex.fileno())
+        dex_size = st.st_size
+        dostime, dosdate = _dos_timestamp(st.st_mtime)
+
+        # classes.dex, with a placeholder CRC until we've seen the data
+        jar.write(_ZIP_LOCAL_HEADER.pack(
+            b'PK\x03\x04', 20, 0, 0, zipfile.ZIP_STORED, dostime, dosdate,
+            0, dex_size, dex_size, len(_DEX_JAR_DEX_NAME), 0))
+        jar.write(_DEX_JAR_DEX_NAME)
+        crc = 0
+        written = 0
+        while True:
+            n = dex.readinto(buf)
+            if not n:
+                break
+            crc = zlib.crc32(view[:n], crc)
+            jar.write(view[:n])
+            written += n
+        assert written == dex_size, dexpath + ' changed while being jarred'
+        jar.seek(_ZIP_LOCAL_HEADER_CRC_OFFSET)
+        jar.write(struct.pack('<L', crc))
+        jar.seek(0, os.SEEK_END)
+
+        manifest_offset = jar.tell()
+        jar.write(_ZIP_LOCAL_HEADER.pack(
+            b'PK\x03\x04', 20, 0, 0, zipfile.ZIP_STORED, dostime, dosdate,
+            _DEX_JAR_MANIFEST_CRC, len(DEX_JAR_MANIFEST),
+            len(DEX_JAR_MANIFEST), len(_DEX_JAR_MANIFEST_NAME), 0))
+        jar.write(_DEX_JAR_MANIFEST_NAME)
+        jar.write(DEX_JAR_MANIFEST)
+
+        central_dir_offset = jar.tell()
+        entries = [
+            (_DEX_JAR_DEX_NAME, crc, dex_size,
+             (st.st_mode & 0xFFFF) << 16, 0),
+            (_DEX_JAR_MANIFEST_NAME, _DEX_JAR_MANIFEST_CRC,
+             len(DEX_JAR_MANIFEST), 0o600 << 16, manifest_offset),
+        ]
+        for name, entry_crc, size, external_attr, offset in entries:
+            jar.write(_ZIP_CENTRAL_DIR.pack(
+                b'PK\x01\x02', 20, 3, 20, 0, 0, zipfile.ZIP_STORED, dostime,
+                dosdate, entry_crc, size, size, len(name), 0, 0, 0, 0,
+                external_attr, offset))
+            jar.write(name)
+        central_dir_size = jar.tell() - central_dir_offset
+        jar.write(_ZIP_END_OF_CENTRAL_DIR.pack(
+            b'PK\x05\x06', 0, 0, len(entries), len(entries),
+            central_dir_size, central_dir_offset, 0))
+    return dex_size
+
+
+def _dos_timestamp(timestamp):
+    # Zip timestamps can't predate 1980; clamp like zipfile's
+    # strict_timestamps=False does.
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1
+    dostime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dosdate = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dostime, dosdate